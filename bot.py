@@ -3,10 +3,24 @@ import os
 import re
 import time
 import json
+import html
+import heapq
 import asyncio
+import itertools
+import tempfile
 import logging
-from typing import Dict, Optional, Set, Tuple, List
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterator, Optional, Set, Tuple, List
+
+try:
+    import orjson  # ixtiyoriy: C'da yozilgan, stdlib json'dan bir necha barobar tez
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop  # ixtiyoriy: libuv asosidagi tezroq event loop (Windows'da yo‘q)
+except ImportError:
+    uvloop = None
 
 from telegram import Update, Message, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatType, ParseMode
@@ -31,6 +45,7 @@ OWNER_IDS_ENV = os.getenv("OWNER_IDS", "").strip()
 
 ALERT_DELAY_SECONDS = int(os.getenv("ALERT_DELAY_SECONDS", "90") or 90)
 DUP_TTL_SECONDS = int(os.getenv("DUP_TTL_SECONDS", str(24 * 60 * 60)) or 86400)  # 24h TTL
+DUP_SEEN_MAX = int(os.getenv("DUP_SEEN_MAX", "50000") or 50000)  # TTL'dan tashqari qattiq chegara
 WARN_ON_DUP = os.getenv("WARN_ON_DUP", "1").strip() not in ("0", "false", "False")
 
 # ===== Persistence files =====
@@ -40,14 +55,15 @@ GROUPS_FILE = os.getenv("GROUPS_FILE", "groups.json").strip()
 INACTIVE_FILE = os.getenv("INACTIVE_FILE", "inactive_groups.json").strip()
 ANALYZE_TEAM_FILE = os.getenv("ANALYZE_TEAM_FILE", "analyze_team.json").strip()
 
-TEAM_USERNAMES: Set[str] = {
+# Har xabarda o‘qiladi, faqat owner buyruqlari o‘zgartiradi — frozenset, o‘zgarganda qayta quriladi
+TEAM_USERNAMES: FrozenSet[str] = frozenset(
     u.strip().lower().lstrip("@")
     for u in TEAM_USERNAMES_ENV.split(",") if u.strip()
-}
-TEAM_USER_IDS: Set[int] = set(
+)
+TEAM_USER_IDS: FrozenSet[int] = frozenset(
     int(x.strip()) for x in TEAM_USER_IDS_ENV.split(",") if x.strip().isdigit()
 )
-OWNER_IDS: Set[int] = set(
+OWNER_IDS: FrozenSet[int] = frozenset(
     int(x.strip()) for x in OWNER_IDS_ENV.split(",") if x.strip().isdigit()
 )
 
@@ -63,240 +79,530 @@ log = logging.getLogger("watchdog-90s")
 # ============
 # Globals
 # ============
-# (chat_id -> (task, last_msg))
-PENDING: Dict[int, Tuple[asyncio.Task, Message]] = {}
+# Watchdog timers: bitta scheduler korutinasi + heap.
+# chat_id -> {"deadline": loop_time, "seq": int, "msg": Message}
+# Yangi xabar kelsa entry joyida yangilanadi (deadline/msg), heap'ga qayta push qilinmaydi.
+PENDING: Dict[int, dict] = {}
+# (deadline_loop_time, seq, chat_id) min-heap; har bir PENDING entry uchun bittadan
+ALERT_HEAP: List[Tuple[float, int, int]] = []
+_ALERT_SEQ = itertools.count(1)
+_ALERT_WAKEUP = asyncio.Event()
+# Hozir yuborilayotgan alert task'lari (GC yig‘ib olmasligi uchun kuchli havola)
+_ALERT_SENDS: Set[asyncio.Task] = set()
 
 # Duplicate detector (PIN-LOAD-ID asosida)
-# Kalit: "PIN:<LOAD_ID>" -> (first_seen_epoch, first_group_id, first_group_title)
-DUP_SEEN: Dict[str, Tuple[float, int, str]] = {}
-# Qaysi (kalit, group_id) bo‘yicha allaqachon alert qilingan — shuni eslab qolamiz
-DUP_ALERTED: Set[Tuple[str, int]] = set()
+# Kalit: LOAD_ID (upper, prefiks yo‘q) -> packed int (first_seen_monotonic << 64 | first_group_id), qarang _pack_seen.
+# Guruh nomi KNOWN_GROUPS'dan olinadi, shuning uchun har bir kalitga bitta int obyekt.
+# Insertion tartibi = vaqt tartibi, shuning uchun eng eskisi har doim boshida (TTL uchun).
+DUP_SEEN: "OrderedDict[str, int]" = OrderedDict()
+# kalit -> allaqachon alert qilingan group_id'lar. Tuple yaratilmaydi; kalit DUP_SEEN'dan
+# chiqsa uning belgilari bitta pop bilan ketadi (butun to‘plamni aylanmasdan)
+DUP_ALERTED: Dict[str, Set[int]] = {}
+_GID_BITS = 64
+_GID_MASK = (1 << _GID_BITS) - 1
+_GID_SIGN = 1 << (_GID_BITS - 1)
 
 # ---------------- PIN-only extractor ----------------
+# Compiled once at import; explicit [A-Za-z0-9] instead of (?i) so the
+# engine does not case-fold every character class test.
 _PIN_LOAD_RE = re.compile(
-    r"(?mi)^\s*(?:📍\s*)?(\d+)\s*#\s*[:：-]?\s*([A-Z0-9]{6,20})\b"
+    r"(?m)^\s*(?:📍\s*)?\d+\s*#\s*[:：-]?\s*([A-Za-z0-9]{6,20})\b"
 )
+_PIN_LOAD_SEARCH = _PIN_LOAD_RE.search
+_PIN_LOAD_FINDITER = _PIN_LOAD_RE.finditer
 
 # --------- Reply-time analytics ---------
-# Har bir chat uchun oxirgi driver xabari va vaqti (sekund epoch)
+# Har bir chat uchun oxirgi driver xabari vaqti (event loop monotonic soati, sekund)
 LAST_DRIVER_TS: Dict[int, float] = {}
 
-# Stats: list of dicts
+# Stats yozuvlari xotirada saqlanmaydi — faqat STATS_FILE'da (JSONL, har javob bitta qator) va AGG'da:
 # {"ts": 1730256000.0, "ym": "2025-10", "user_id": 123, "username": "alex", "name": "Alex", "seconds": 42.0}
-STATS: List[dict] = []
+
+# Oylik agregat: ym -> {(user_id, username): {"name", "sum", "count"}}
+# _record_reply/_load_stats yangilaydi; /analiz faqat kerakli oyni o‘qiydi.
+# (username kalitda — MyTeam filtri yozuv darajasida ishlagani kabi qolsin)
+AGG: Dict[str, Dict[Tuple[int, str], dict]] = {}
 
 # Group registry and activation flags
 KNOWN_GROUPS: Dict[int, str] = {}          # chat_id -> title
+# (title.lower(), chat_id, title) — /runninggroups uchun; KNOWN_GROUPS o‘zgarganda qayta quriladi
+_GROUPS_SORTED: List[Tuple[str, int, str]] = []
 INACTIVE_GROUPS: Set[int] = set()          # chat_id that are paused
 
 # Team-only analysis whitelist (lowercase usernames without @)
-ANALYZE_TEAM: Set[str] = set()
+ANALYZE_TEAM: FrozenSet[str] = frozenset()
 
 # ============ Persistence helpers ============
 
+if orjson is not None:
+    def _json_dumps(data) -> bytes:
+        # KNOWN_GROUPS int kalitli — stdlib json kabi str'ga o‘giriladi
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+    _json_loads = json.loads
+
+
 def _load_json(path: str, default):
     try:
         if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(path, "rb") as f:
+                return _json_loads(f.read())
     except Exception as e:
         log.warning("Could not load %s: %s", path, e)
     return default
 
 
-def _save_json(path: str, data) -> None:
+def _fsync_dir(path: str) -> None:
+    # rename'ning o‘zi ham diskka tushishi uchun katalogni fsync qilamiz (Windows'da O_DIRECTORY yo‘q)
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _atomic_write(path: str, payload: bytes) -> None:
+    # Har yozishga o‘z tmp fayli — bir vaqtda ikki thread bir xil <path>.tmp'ni buzmasligi uchun
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".", suffix=".tmp")
     try:
-        tmp = path + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False)
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
         os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(path)
+
+
+def _save_json(path: str, data) -> None:
+    try:
+        _atomic_write(path, _json_dumps(data))
     except Exception as e:
         log.warning("Could not save %s: %s", path, e)
 
 
 def _load_stats() -> None:
-    global STATS
-    STATS = _load_json(STATS_FILE, []) or []
+    """STATS_FILE — JSONL (har qatorda bitta yozuv). Eski JSON-massiv formati bir marta JSONL'ga o‘giriladi."""
+    recs: List[dict] = []
+    AGG.clear()
+    if not os.path.exists(STATS_FILE):
+        return
+    try:
+        with open(STATS_FILE, "rb") as f:
+            head = f.read(1)
+            f.seek(0)
+            if head == b"[":
+                recs = _json_loads(f.read()) or []
+                legacy = True
+            else:
+                legacy = False
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        recs.append(_json_loads(line))
+                    except ValueError:
+                        log.warning("Skipping bad stats line in %s", STATS_FILE)
+    except Exception as e:
+        log.warning("Could not load %s: %s", STATS_FILE, e)
+        return
+    for rec in recs:
+        _agg_add(rec)
+    if legacy:
+        _save_stats(recs)
+
+
+def _agg_add(rec: dict) -> None:
+    uid = int(rec.get("user_id", 0))
+    uname = (rec.get("username") or "").lower()
+    per_month = AGG.setdefault(rec.get("ym"), {})
+    bucket = per_month.get((uid, uname))
+    if bucket is None:
+        bucket = per_month[(uid, uname)] = {
+            "name": rec.get("name") or rec.get("username") or str(uid),
+            "sum": 0.0,
+            "count": 0.0,
+        }
+    bucket["sum"] += float(rec.get("seconds", 0.0))
+    bucket["count"] += 1.0
+
 
+def _save_stats(recs: List[dict]) -> None:
+    """recs'ni STATS_FILE'ga to‘liq, atomik qayta yozadi (faqat eski JSON-massiv formatidan migratsiya uchun)."""
+    try:
+        _atomic_write(STATS_FILE, b"".join(_json_dumps(rec) + b"\n" for rec in recs))
+    except Exception as e:
+        log.warning("Could not save %s: %s", STATS_FILE, e)
+
+
+def _append_stats(recs: List[dict]) -> None:
+    # Butun faylni qayta yozmaymiz — bir nechta qatorni bitta write bilan qo‘shamiz
+    try:
+        with open(STATS_FILE, "ab") as f:
+            f.write(b"".join(_json_dumps(rec) + b"\n" for rec in recs))
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as e:
+        log.warning("Could not append to %s: %s", STATS_FILE, e)
 
-def _save_stats() -> None:
-    _save_json(STATS_FILE, STATS)
+
+# ---- Stats writer: _record_reply faqat navbatga qo‘yadi, bitta uzoq yashovchi task yozadi ----
+STATS_FLUSH_SEC = 1.0
+STATS_BATCH_MAX = 128
+STATS_QUEUE: "asyncio.Queue[dict]" = asyncio.Queue()
+
+
+def _drain_stats_queue(limit: Optional[int] = None) -> List[dict]:
+    batch: List[dict] = []
+    while not STATS_QUEUE.empty() and (limit is None or len(batch) < limit):
+        batch.append(STATS_QUEUE.get_nowait())
+    return batch
+
+
+async def _stats_writer_loop() -> None:
+    # Fayl faqat shu task tomonidan (append) yoziladi — qayta yozish yo‘q, shuning uchun lock ham kerak emas
+    while True:
+        batch = [await STATS_QUEUE.get()]
+        # qisqa kutamiz — shu orada kelganlar bitta write'ga tushadi
+        try:
+            await asyncio.sleep(STATS_FLUSH_SEC)
+        except asyncio.CancelledError:
+            # shutdown: qo‘lda turgan batch yo‘qolmasin
+            _append_stats(batch + _drain_stats_queue())
+            raise
+        batch.extend(_drain_stats_queue(STATS_BATCH_MAX - 1))
+        await asyncio.to_thread(_append_stats, batch)
 
 
 def _record_reply(user_id: int, username: str, name: str, seconds: float, ts: Optional[float] = None):
     if ts is None:
         ts = time.time()
-    ym = datetime.fromtimestamp(ts).strftime("%Y-%m")
-    STATS.append({
+    tm = time.localtime(ts)
+    ym = f"{tm.tm_year:04d}-{tm.tm_mon:02d}"
+    rec = {
         "ts": ts,
         "ym": ym,
         "user_id": int(user_id),
         "username": (username or "").lower(),
         "name": name or "",
         "seconds": float(seconds)
-    })
-    _save_stats()
+    }
+    _agg_add(rec)
+    STATS_QUEUE.put_nowait(rec)
 
 
 def _load_groups() -> None:
     global KNOWN_GROUPS, INACTIVE_GROUPS, ANALYZE_TEAM
-    KNOWN_GROUPS = _load_json(GROUPS_FILE, {}) or {}
+    # JSON kalitlari str bo‘lib qaytadi — chat.id (int) bilan solishtirish uchun int'ga o‘giramiz
+    KNOWN_GROUPS = {int(gid): title for gid, title in (_load_json(GROUPS_FILE, {}) or {}).items()}
+    _refresh_sorted_groups()
     INACTIVE_GROUPS = set(_load_json(INACTIVE_FILE, []) or [])
-    ANALYZE_TEAM = set((u or "").lower().lstrip("@") for u in (_load_json(ANALYZE_TEAM_FILE, []) or []))
+    ANALYZE_TEAM = frozenset((u or "").lower().lstrip("@") for u in (_load_json(ANALYZE_TEAM_FILE, []) or []))
+
+
+def _refresh_sorted_groups() -> None:
+    global _GROUPS_SORTED
+    _GROUPS_SORTED = sorted((title.lower(), gid, title) for gid, title in KNOWN_GROUPS.items())
+
 
+# Har biri faqat o‘z faylini belgilaydi — bitta o‘zgarish uchun uchta fayl yozilmaydi
+def _save_groups_known() -> None:
+    _mark_dirty("groups")
 
-def _save_groups() -> None:
-    _save_json(GROUPS_FILE, KNOWN_GROUPS)
-    _save_json(INACTIVE_FILE, list(sorted(INACTIVE_GROUPS)))
-    _save_json(ANALYZE_TEAM_FILE, list(sorted(ANALYZE_TEAM)))
+
+def _save_groups_inactive() -> None:
+    _mark_dirty("inactive")
+
+
+def _save_groups_team() -> None:
+    _mark_dirty("team")
+
+
+# ---- Write-behind: o‘zgarishlar faqat belgilanadi, _persist_loop har PERSIST_INTERVAL_SEC'da yozadi ----
+PERSIST_INTERVAL_SEC = 2.0
+_DIRTY: Set[str] = set()
+_FLUSH_INFLIGHT: Optional[asyncio.Future] = None  # hozir thread'da ketayotgan _write_all
+
+
+def _mark_dirty(name: str) -> None:
+    _DIRTY.add(name)
+
+
+def _dirty_snapshot() -> List[Tuple[str, object]]:
+    # Event loop ichida nusxa olamiz — thread'da yozilayotganda handlerlar bemalol o‘zgartiraveradi
+    writes: List[Tuple[str, object]] = []
+    if "groups" in _DIRTY:
+        writes.append((GROUPS_FILE, dict(KNOWN_GROUPS)))
+    if "inactive" in _DIRTY:
+        writes.append((INACTIVE_FILE, sorted(INACTIVE_GROUPS)))
+    if "team" in _DIRTY:
+        writes.append((ANALYZE_TEAM_FILE, sorted(ANALYZE_TEAM)))
+    _DIRTY.clear()
+    return writes
+
+
+def _write_all(writes: List[Tuple[str, object]]) -> None:
+    for path, data in writes:
+        _save_json(path, data)
+
+
+async def _flush_dirty() -> None:
+    global _FLUSH_INFLIGHT
+    # Bekor qilingan persist task'ning to_thread'i fonda yozishda davom etadi — avval o‘shani kutamiz
+    if _FLUSH_INFLIGHT is not None and not _FLUSH_INFLIGHT.done():
+        await asyncio.wait([_FLUSH_INFLIGHT])
+    if _DIRTY:
+        _FLUSH_INFLIGHT = asyncio.ensure_future(asyncio.to_thread(_write_all, _dirty_snapshot()))
+        await asyncio.shield(_FLUSH_INFLIGHT)
+
+
+async def _persist_loop() -> None:
+    while True:
+        await asyncio.sleep(PERSIST_INTERVAL_SEC)
+        try:
+            await _flush_dirty()
+        except Exception:
+            log.exception("Persist flush failed")
 
 
 # ============ Helpers ============
 
+def _text(msg: Message) -> str:
+    return msg.text or msg.caption or ""
+
+
+_GROUP_TYPES: FrozenSet[str] = frozenset((ChatType.GROUP, ChatType.SUPERGROUP))
+
+
 def is_group(update: Update) -> bool:
     chat = update.effective_chat
-    return chat and chat.type in (ChatType.GROUP, ChatType.SUPERGROUP)
+    return chat and chat.type in _GROUP_TYPES
 
 
 def is_main(chat_id: int) -> bool:
     return MAIN_GROUP_ID is not None and chat_id == MAIN_GROUP_ID
 
 
+# user_id -> team a’zoligi; /addteam va /removeteam tozalaydi (username kamdan-kam o‘zgaradi)
+TEAM_CACHE_MAX = 4096
+_TEAM_CACHE: "OrderedDict[int, bool]" = OrderedDict()
+
+
 def is_team_user(update: Update) -> bool:
     u = update.effective_user
     if not u or u.is_bot:
         return False
-    if u.id in TEAM_USER_IDS:
-        return True
-    uname = (u.username or "").lower()
-    return uname in TEAM_USERNAMES
+    cached = _TEAM_CACHE.get(u.id)
+    if cached is not None:
+        return cached
+    result = u.id in TEAM_USER_IDS or (u.username or "").lower() in TEAM_USERNAMES
+    _TEAM_CACHE[u.id] = result
+    if len(_TEAM_CACHE) > TEAM_CACHE_MAX:
+        _TEAM_CACHE.popitem(last=False)
+    return result
 
 
 def is_owner(user_id: Optional[int]) -> bool:
-    # OWNER_IDS bo'sh bo'lsa, hech kim owner emas.
-    return bool(user_id and OWNER_IDS and user_id in OWNER_IDS)
+    # OWNER_IDS bo'sh bo'lsa, hech kim owner emas (None/0 ham hech qachon to‘plamda bo‘lmaydi).
+    return user_id in OWNER_IDS
 
 
-async def cancel_pending(chat_id: int):
-    pair = PENDING.pop(chat_id, None)
-    if pair:
-        task, _ = pair
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
+def cancel_pending(chat_id: int) -> None:
+    # Heap'dagi eski entry qoladi, lekin seq mos kelmagani uchun ishlamaydi
+    PENDING.pop(chat_id, None)
 
 
-async def schedule_alert(context: ContextTypes.DEFAULT_TYPE, chat_id: int, msg: Message):
+def schedule_alert(chat_id: int, msg: Message) -> None:
     # Agar guruh PAUSED bo'lsa — hech narsa qilmaymiz
     if chat_id in INACTIVE_GROUPS:
         return
 
     # har safar yangidan taymer — oxirgi xabar bo‘yicha
-    await cancel_pending(chat_id)
+    deadline = asyncio.get_running_loop().time() + ALERT_DELAY_SECONDS
+    entry = PENDING.get(chat_id)
+    if entry is not None:
+        # taymer hali ishlamagan — joyida uzaytiramiz, scheduler o‘zi qayta o‘qiydi
+        entry["deadline"] = deadline
+        entry["msg"] = msg
+        return
+    seq = next(_ALERT_SEQ)
+    PENDING[chat_id] = {"deadline": deadline, "seq": seq, "msg": msg}
+    heapq.heappush(ALERT_HEAP, (deadline, seq, chat_id))
+    _ALERT_WAKEUP.set()
+
+
+# Plain text: guruh nomi/ism/snippet foydalanuvchidan keladi, Markdown'da `_`/`*` xato beradi
+# Kechikish o‘zgarmaydi — import paytida shablonga kiritib qo‘yamiz
+_ALERT_TEMPLATE = (
+    f"🚨 No team reply in {ALERT_DELAY_SECONDS} sec\n"
+    "👥 Group: {title}\n"
+    "👤 From: {sender}\n\n"
+    "{snippet}"
+)
+_DUP_TEMPLATE = (
+    "⚠️ WARNING: POSSIBLE DUPLICATE IN MULTIPLE DRIVER GROUPS\n"
+    "📦 Load ID: {load_id}\n"
+    "👥 Group 1: {group1}\n"
+    "👥 Group 2: {group2}\n"
+    "👤 Sender: {sender_name}\n"
+    "Immediate action required: verify assignment to prevent double-booking, penalties, and pay conflicts."
+)
 
-    async def _job():
-        try:
-            await asyncio.sleep(ALERT_DELAY_SECONDS)
-            if MAIN_GROUP_ID is None:
-                log.warning("MAIN_GROUP_ID not set; skipping alert")
-                return
-            group_title = msg.chat.title or "(no title)"
-            sender = msg.from_user.full_name if msg.from_user else "(unknown)"
-            snippet = msg.text or msg.caption or "(non-text message)"
-            header = (
-                f"🚨 *No team reply in {ALERT_DELAY_SECONDS} sec*\n"
-                f"👥 *Group:* {group_title}\n"
-                f"👤 *From:* {sender}\n\n"
-                f"{snippet[:4000]}"
-            )
-            await context.bot.send_message(
-                chat_id=MAIN_GROUP_ID,
-                text=header,
-                parse_mode=ParseMode.MARKDOWN,
-                disable_web_page_preview=True,
-            )
-        finally:
-            PENDING.pop(chat_id, None)
-
-    task = asyncio.create_task(_job())
-    PENDING[chat_id] = (task, msg)
-
-
-def _purge_expired_duplicates() -> None:
-    if not DUP_SEEN:
+
+async def _send_alert(bot, msg: Message) -> None:
+    if MAIN_GROUP_ID is None:
+        log.warning("MAIN_GROUP_ID not set; skipping alert")
         return
-    cutoff = time.time() - DUP_TTL_SECONDS
-    to_del = [k for k, (ts, _, _) in DUP_SEEN.items() if ts < cutoff]
-    for k in to_del:
-        DUP_SEEN.pop(k, None)
-    if DUP_ALERTED:
-        to_keep = {(key, gid) for (key, gid) in DUP_ALERTED if key in DUP_SEEN}
-        DUP_ALERTED.clear()
-        DUP_ALERTED.update(to_keep)
-
-
-def _extract_pin_load_ids(text: str) -> Set[str]:
-    """Faqat 📍 <n># : <LOAD_ID> formatidan ID qaytaradi. Kalit: PIN:<LOAD_ID>"""
-    ids: Set[str] = set()
-    if not text:
-        return ids
-    for _, load_id in _PIN_LOAD_RE.findall(text):
-        lid = load_id.upper()
-        ids.add(f"PIN:{lid}")
-    return ids
-
-
-async def process_pin_duplicate_forward(context: ContextTypes.DEFAULT_TYPE, msg: Message):
-    """
-    Bir xil 📍 <n># : <LOAD_ID> ikki xil driver guruhida ko‘rilsa:
-      - agar WARN_ON_DUP=1 bo‘lsa → MAIN’ga WARNING yuboriladi
-      - forward QILINMAYDI (faqat warning)
-    (Har bir (key, group_id) uchun faqat bir marta).
+    group_title = msg.chat.title or "(no title)"
+    sender = msg.from_user.full_name if msg.from_user else "(unknown)"
+    snippet = _text(msg) or "(non-text message)"
+    header = _ALERT_TEMPLATE.format(title=group_title, sender=sender, snippet=snippet[:4000])
+    await bot.send_message(
+        chat_id=MAIN_GROUP_ID,
+        text=header,
+        disable_web_page_preview=True,
+    )
+
+
+async def _alert_scheduler(bot) -> None:
+    """Yagona watchdog korutinasi: ALERT_HEAP'dan muddati o‘tgan alertlarni yuboradi."""
+    loop = asyncio.get_running_loop()
+    while True:
+        if not ALERT_HEAP:
+            _ALERT_WAKEUP.clear()
+            await _ALERT_WAKEUP.wait()
+            continue
+
+        deadline, seq, chat_id = ALERT_HEAP[0]
+        delay = deadline - loop.time()
+        if delay > 0:
+            # wait_for o‘rniga TimerHandle: task yaratilmaydi, cancel() O(1)
+            _ALERT_WAKEUP.clear()
+            handle = loop.call_later(delay, _ALERT_WAKEUP.set)
+            try:
+                await _ALERT_WAKEUP.wait()
+            finally:
+                handle.cancel()
+            continue
+
+        heapq.heappop(ALERT_HEAP)
+        entry = PENDING.get(chat_id)
+        if entry is None or entry["seq"] != seq:
+            # bekor qilingan (yoki keyin yangi taymer ochilgan)
+            continue
+        if entry["deadline"] > deadline:
+            # orada yangi xabar kelib deadline surilgan
+            heapq.heappush(ALERT_HEAP, (entry["deadline"], seq, chat_id))
+            continue
+        del PENDING[chat_id]
+        # Yuborish alohida qisqa task'da — sekin API javobi boshqa chatlarni kechiktirmasin
+        task = asyncio.create_task(_deliver_alert(bot, chat_id, entry["msg"]))
+        _ALERT_SENDS.add(task)
+        task.add_done_callback(_ALERT_SENDS.discard)
+
+
+async def _deliver_alert(bot, chat_id: int, msg: Message) -> None:
+    try:
+        await _send_alert(bot, msg)
+    except Exception:
+        log.exception("Alert send failed for chat %s", chat_id)
+
+
+def _pack_seen(ts: float, gid: int) -> int:
+    return (int(ts) << _GID_BITS) | (gid & _GID_MASK)
+
+
+def _unpack_seen(v: int) -> Tuple[int, int]:
+    gid = v & _GID_MASK
+    if gid & _GID_SIGN:
+        gid -= 1 << _GID_BITS
+    return v >> _GID_BITS, gid
+
+
+def _drop_oldest_seen() -> None:
+    key, _ = DUP_SEEN.popitem(last=False)
+    DUP_ALERTED.pop(key, None)
+
+
+def _purge_expired_duplicates(now: float) -> None:
+    # Faqat boshidagi muddati o‘tganlarni olib tashlaymiz — O(expired), butun dict emas
+    # (packed qiymatni cutoff bilan to‘g‘ridan-to‘g‘ri solishtiramiz: ts yuqori bitlarda)
+    cutoff = int(now - DUP_TTL_SECONDS) << _GID_BITS
+    while DUP_SEEN:
+        if next(iter(DUP_SEEN.values())) >= cutoff:
+            break
+        _drop_oldest_seen()
+
+
+def _extract_pin_load_ids(text: str) -> Iterator[str]:
+    """Faqat 📍 <n># : <LOAD_ID> formatidan LOAD_ID'larni (upper) ketma-ket beradi.
+
+    Set qurilmaydi: bir xabardagi takror ID'ni DUP_SEEN/DUP_ALERTED o‘zi e’tiborsiz qoldiradi.
     """
-    if not msg or not msg.chat or not MAIN_GROUP_ID:
+    # Regex literal '#' talab qiladi — '#' bo‘lmasa regex'ni umuman ishga tushirmaymiz
+    if not text or "#" not in text:
         return
-    chat = msg.chat
-    if chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
-        return
-    if chat.id == MAIN_GROUP_ID:
+    # Avval search: PIN yo‘q bo‘lsa iterator umuman yaratilmaydi; bor bo‘lsa qolganini shu joydan davom ettiramiz
+    first = _PIN_LOAD_SEARCH(text)
+    if first is None:
         return
+    yield first.group(1).upper()
+    for m in _PIN_LOAD_FINDITER(text, first.end()):
+        yield m.group(1).upper()
 
-    _purge_expired_duplicates()
 
-    text = msg.text or msg.caption or ""
-    keys = _extract_pin_load_ids(text)
-    if not keys:
-        return
+async def process_pin_duplicate_forward(context: ContextTypes.DEFAULT_TYPE, msg: Message, text: str):
+    """
+    Bir xil 📍 <n># : <LOAD_ID> ikki xil driver guruhida ko‘rilsa:
+      - agar WARN_ON_DUP=1 bo‘lsa → MAIN’ga WARNING yuboriladi
+      - forward QILINMAYDI (faqat warning)
+    (Har bir (load_id, group_id) uchun faqat bir marta).
 
-    log.info("PINFWD: found keys=%s in group_id=%s", keys, chat.id)
+    Chaqiruvchi (driver_message_handler) guruh turi, MAIN va '#' tekshiruvlarini allaqachon qilgan.
+    """
+    chat = msg.chat
 
-    for key in keys:
-        first = DUP_SEEN.get(key)
-        if not first:
-            DUP_SEEN[key] = (
-                time.time(),
-                chat.id,
-                (chat.title or f"id:{chat.id}")
-            )
+    now = time.monotonic()
+    _purge_expired_duplicates(now)
+    # Har bir PIN uchun yoziladi — production'da (INFO) o‘chiq, tekshiruv bir marta
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    for load_id in _extract_pin_load_ids(text):
+        if debug:
+            log.debug("PINFWD: found load_id=%s in group_id=%s", load_id, chat.id)
+        first = DUP_SEEN.get(load_id)
+        if first is None:
+            DUP_SEEN[load_id] = _pack_seen(now, chat.id)
+            if len(DUP_SEEN) > DUP_SEEN_MAX:
+                _drop_oldest_seen()
             continue
 
-        _, first_gid, first_title = first
+        _, first_gid = _unpack_seen(first)
         if first_gid == chat.id:
             # shu guruh ichida ko‘rildi — e’tibor bermaymiz
             continue
 
-        mark = (key, chat.id)
-        if mark in DUP_ALERTED:
+        alerted = DUP_ALERTED.setdefault(load_id, set())
+        if chat.id in alerted:
             continue
-        DUP_ALERTED.add(mark)
+        alerted.add(chat.id)
 
         # Warning (faqat xabar, forward yo‘q)
         if WARN_ON_DUP:
-            load_id = key.split(":", 1)[1]
-
-            group1 = first_title or "(no title)"
+            group1 = KNOWN_GROUPS.get(first_gid) or f"id:{first_gid}"
             group2 = chat.title or "(no title)"
             sender_name = "(unknown)"
             try:
@@ -315,19 +621,13 @@ async def process_pin_duplicate_forward(context: ContextTypes.DEFAULT_TYPE, msg:
             try:
                 await context.bot.send_message(
                     chat_id=MAIN_GROUP_ID,
-                    text=(
-                        "⚠️ WARNING: POSSIBLE DUPLICATE IN MULTIPLE DRIVER GROUPS\n"
-                        f"📦 Load ID: {load_id}\n"
-                        f"👥 Group 1: {group1}\n"
-                        f"👥 Group 2: {group2}\n"
-                        f"👤 Sender: {sender_name}\n"
-                        "Immediate action required: verify assignment to prevent double-booking, penalties, and pay conflicts."
+                    text=_DUP_TEMPLATE.format(
+                        load_id=load_id, group1=group1, group2=group2, sender_name=sender_name
                     ),
-                    parse_mode=ParseMode.MARKDOWN,
                     disable_web_page_preview=True,
                 )
             except Exception:
-                log.exception("PINFWD: warning send failed for %s", key)
+                log.exception("PINFWD: warning send failed for %s", load_id)
 
 
 # ================ Commands ================
@@ -365,44 +665,60 @@ async def set_main_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     global MAIN_GROUP_ID
     MAIN_GROUP_ID = update.effective_chat.id
+    # MAIN xabarlari driver handler'ga yetib bormaydi — /runninggroups uchun shu yerda ro‘yxatga olamiz
+    _ensure_group_registered(update.effective_chat)
     await update.message.reply_text(f"MAIN group set to: {MAIN_GROUP_ID}")
 
 
+# /addteam, /removeteam tokeni: raqam → user_id (1-guruh), aks holda Telegram username (2-guruh)
+_TEAM_TOKEN_RE = re.compile(r"@?(?:([0-9]+)|([A-Za-z0-9_]{3,32}))")
+
+
+def _parse_team_args(args: List[str]) -> Tuple[Set[int], Set[str]]:
+    """/addteam, /removeteam argumentlari: raqam → user_id, qolgani → username (lowercase, @siz).
+
+    Username formatiga mos kelmagan tokenlar tashlab ketiladi.
+    """
+    ids: Set[int] = set()
+    names: Set[str] = set()
+    for token in args:
+        m = _TEAM_TOKEN_RE.fullmatch(token)
+        if m is None:
+            continue
+        uid, name = m.groups()
+        if uid is not None:
+            ids.add(int(uid))
+        else:
+            names.add(name.lower())
+    return ids, names
+
+
+def _team_label(ids: Set[int], names: Set[str]) -> str:
+    return ", ".join([str(i) for i in sorted(ids)] + ["@" + n for n in sorted(names)]) or "(none)"
+
+
 async def add_team_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
-    added = []
-    for token in context.args:
-        t = token.strip()
-        if not t:
-            continue
-        if t.startswith("@"):
-            t = t[1:]
-        if t.isdigit():
-            TEAM_USER_IDS.add(int(t)); added.append(t)
-        else:
-            TEAM_USERNAMES.add(t.lower()); added.append("@"+t.lower())
-    await update.message.reply_text("Added to TEAM: " + (", ".join(added) or "(none)"))
+    global TEAM_USER_IDS, TEAM_USERNAMES
+    ids, names = _parse_team_args(context.args)
+    TEAM_USER_IDS = TEAM_USER_IDS | ids
+    TEAM_USERNAMES = TEAM_USERNAMES | names
+    _TEAM_CACHE.clear()
+    await update.message.reply_text("Added to TEAM: " + _team_label(ids, names))
 
 
 async def remove_team_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
-    removed = []
-    for token in context.args:
-        t = token.strip()
-        if not t:
-            continue
-        if t.startswith("@"):
-            t = t[1:]
-        if t.isdigit():
-            if int(t) in TEAM_USER_IDS:
-                TEAM_USER_IDS.remove(int(t)); removed.append(t)
-        else:
-            tl = t.lower()
-            if tl in TEAM_USERNAMES:
-                TEAM_USERNAMES.remove(tl); removed.append("@"+tl)
-    await update.message.reply_text("Removed from TEAM: " + (", ".join(removed) or "(none)"))
+    global TEAM_USER_IDS, TEAM_USERNAMES
+    ids, names = _parse_team_args(context.args)
+    ids &= TEAM_USER_IDS
+    names &= TEAM_USERNAMES
+    TEAM_USER_IDS = TEAM_USER_IDS - ids
+    TEAM_USERNAMES = TEAM_USERNAMES - names
+    _TEAM_CACHE.clear()
+    await update.message.reply_text("Removed from TEAM: " + _team_label(ids, names))
 
 
 async def list_team_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -423,12 +739,13 @@ async def clearseen_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ---------- Running groups registry & toggles ----------
-async def _ensure_group_registered(chat) -> None:
-    if not chat or chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+def _ensure_group_registered(chat) -> None:
+    if not chat or chat.type not in _GROUP_TYPES:
         return
     if chat.id not in KNOWN_GROUPS:
         KNOWN_GROUPS[chat.id] = chat.title or f"id:{chat.id}"
-        _save_groups()
+        _refresh_sorted_groups()
+        _save_groups_known()
 
 
 async def running_groups_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -438,31 +755,32 @@ async def running_groups_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not KNOWN_GROUPS:
         await update.message.reply_text("No groups registered yet.")
         return
-    lines = ["📋 *Running groups (known by bot):*", "(Active by default; 'Paused' means watchdog disabled)"]
-    for gid, title in sorted(KNOWN_GROUPS.items(), key=lambda x: x[1].lower()):
+    # Guruh nomlari foydalanuvchi matni — Markdown o‘rniga HTML + escape ('_' / '*' xato bermaydi)
+    lines = ["📋 <b>Running groups (known by bot):</b>", "(Active by default; 'Paused' means watchdog disabled)"]
+    for _, gid, title in _GROUPS_SORTED:
         state = "Paused" if gid in INACTIVE_GROUPS else "Active"
         mark = "⏸️" if state == "Paused" else "▶️"
-        lines.append(f"{mark} {title} — `{gid}` — {state}")
-    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+        lines.append(f"{mark} {html.escape(title)} — <code>{gid}</code> — {state}")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
 
 async def _toggle_group_active(update: Update, context: ContextTypes.DEFAULT_TYPE, active: bool):
     if not is_owner(update.effective_user.id):
         return
     chat = update.effective_chat
-    if not chat or chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+    if not chat or chat.type not in _GROUP_TYPES:
         await update.message.reply_text("Run this inside a *group*.", parse_mode=ParseMode.MARKDOWN)
         return
-    await _ensure_group_registered(chat)
+    _ensure_group_registered(chat)
     if active:
         INACTIVE_GROUPS.discard(chat.id)
         await update.message.reply_text("This group is now *Active*. Watchdog enabled.", parse_mode=ParseMode.MARKDOWN)
     else:
         INACTIVE_GROUPS.add(chat.id)
         # cancel any pending timers for this chat
-        await cancel_pending(chat.id)
+        cancel_pending(chat.id)
         await update.message.reply_text("This group is now *Paused*. Watchdog disabled.", parse_mode=ParseMode.MARKDOWN)
-    _save_groups()
+    _save_groups_inactive()
 
 
 # Accept both exact and numbered variants (e.g., /inactivategroup1)
@@ -476,19 +794,29 @@ async def activate_group_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 # ---------- ANALYSIS: UI & logic ----------
 
+# (year, month, n_months, prefix) -> klaviatura; natija oyiga bir marta o‘zgaradi
+_MONTH_BTN_CACHE: Dict[Tuple[int, int, int, str], InlineKeyboardMarkup] = {}
+
+
 def _month_buttons(n_months: int = 6, prefix: str = "ANALYZE") -> InlineKeyboardMarkup:
-    today = datetime.now()
+    tm = time.localtime()
+    key = (tm.tm_year, tm.tm_mon, n_months, prefix)
+    cached = _MONTH_BTN_CACHE.get(key)
+    if cached is not None:
+        return cached
+    # Joriy oydan orqaga — butun sonli (yil, oy) arifmetikasi, datetime/timedelta'siz
+    year, month = tm.tm_year, tm.tm_mon
     months = []
-    cur = datetime(today.year, today.month, 1)
     for _ in range(n_months):
-        label = cur.strftime("%Y-%m")
-        months.append(label)
-        # previous month
-        prev_month = cur.replace(day=1) - timedelta(days=1)
-        cur = datetime(prev_month.year, prev_month.month, 1)
-    rows = [months[i:i+3] for i in range(0, len(months), 3)]
-    keyboard = [[InlineKeyboardButton(m, callback_data=f"{prefix}:{m}") for m in row] for row in rows]
-    return InlineKeyboardMarkup(keyboard)
+        months.append(f"{year:04d}-{month:02d}")
+        month -= 1
+        if month == 0:
+            year, month = year - 1, 12
+    markup = _MONTH_BTN_CACHE[key] = InlineKeyboardMarkup([
+        [InlineKeyboardButton(m, callback_data=f"{prefix}:{m}") for m in months[i:i + 3]]
+        for i in range(0, len(months), 3)
+    ])
+    return markup
 
 
 async def analiz_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -518,7 +846,7 @@ async def analiz_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def _build_analysis_text(month: str, only_myteam: bool = False) -> str:
-    # Aggregate
+    # Aggregate (oldindan hisoblangan AGG'dan — yozuvlarni to‘liq aylanmaymiz)
     per_user: Dict[int, Dict[str, float]] = {}
 
     def _is_allowed_username(u: str) -> bool:
@@ -526,58 +854,54 @@ async def _build_analysis_text(month: str, only_myteam: bool = False) -> str:
             return True
         if not ANALYZE_TEAM:
             return False
-        return (u or "").lower() in ANALYZE_TEAM
+        return u in ANALYZE_TEAM
 
-    for rec in STATS:
-        if rec.get("ym") != month:
-            continue
-        uname = (rec.get("username") or "").lower()
+    for (uid, uname), bucket in AGG.get(month, {}).items():
         if not _is_allowed_username(uname):
             continue
-        uid = int(rec.get("user_id", 0))
-        per_user.setdefault(uid, {
-            "name": rec.get("name") or rec.get("username") or str(uid),
-            "sum": 0.0,
-            "count": 0.0,
-        })
-        per_user[uid]["sum"] += float(rec.get("seconds", 0.0))
-        per_user[uid]["count"] += 1.0
+        d = per_user.setdefault(uid, {"name": bucket["name"], "sum": 0.0, "count": 0.0})
+        d["sum"] += bucket["sum"]
+        d["count"] += bucket["count"]
 
     if not per_user:
         scope = "MyTeam" if only_myteam else "All Team"
-        return f"No data for {month} ({scope})."
+        return f"No data for {html.escape(month)} ({scope})."
 
     # Sort by avg asc, then count desc
-    rows = []
-    for uid, d in per_user.items():
-        avg = (d["sum"] / d["count"]) if d["count"] else 0.0
-        rows.append((avg, d["count"], d["name"]))
+    rows = [
+        ((d["sum"] / d["count"]) if d["count"] else 0.0, int(d["count"]), d["name"])
+        for d in per_user.values()
+    ]
     rows.sort(key=lambda x: (x[0], -x[1]))
 
     scope = "MyTeam" if only_myteam else "All Team"
-    lines = [f"📊 *Reply-time analysis for {month}* — _{scope}_ (lower is better)"]
-    rank = 1
-    for avg, cnt, name in rows:
-        lines.append(f"{rank}. {name} — avg {int(round(avg))}s (n={int(cnt)})")
-        rank += 1
-    return "\n".join(lines)
+    header = f"📊 <b>Reply-time analysis for {html.escape(month)}</b> — <i>{scope}</i> (lower is better)"
+    body = "\n".join(
+        f"{rank}. {html.escape(name)} — avg {int(round(avg))}s (n={cnt})"
+        for rank, (avg, cnt, name) in enumerate(rows, 1)
+    )
+    return header + "\n" + body
 
 
-async def analiz_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.callback_query:
-        return
+async def _answer_analysis(update: Update, only_myteam: bool):
     cq = update.callback_query
+    if not cq:
+        return
     if not is_owner(cq.from_user.id):
         await cq.answer("Not authorized.", show_alert=True)
         return
-    if not cq.data or not (cq.data.startswith("ANALYZE:") or cq.data.startswith("ANALYZE_MY:")):
-        return
+    # Prefiksni handler pattern'i allaqachon tanlagan — faqat oyni ajratamiz
+    month = cq.data.partition(":")[2]  # "YYYY-MM"
+    text = await _build_analysis_text(month, only_myteam=only_myteam)
+    await cq.edit_message_text(text, parse_mode=ParseMode.HTML)
 
-    only_myteam = cq.data.startswith("ANALYZE_MY:")
-    month = cq.data.split(":", 1)[1]  # "YYYY-MM"
 
-    text = await _build_analysis_text(month, only_myteam=only_myteam)
-    await cq.edit_message_text(text, parse_mode=ParseMode.MARKDOWN)
+async def analiz_cb_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _answer_analysis(update, only_myteam=False)
+
+
+async def analiz_cb_my(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _answer_analysis(update, only_myteam=True)
 
 
 # ---------- MyTeam-only analysis setup ----------
@@ -585,14 +909,9 @@ async def myteam_setup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id):
         return
     # Expect a list of usernames or @usernames
-    newset: Set[str] = set()
-    for tok in context.args:
-        t = tok.strip().lower().lstrip("@")
-        if t:
-            newset.add(t)
     global ANALYZE_TEAM
-    ANALYZE_TEAM = newset
-    _save_groups()
+    ANALYZE_TEAM = frozenset(t for t in (tok.strip().lower().lstrip("@") for tok in context.args) if t)
+    _save_groups_team()
     if ANALYZE_TEAM:
         await update.message.reply_text(
             "MyTeam for analysis set to: " + ", ".join(sorted(ANALYZE_TEAM))
@@ -602,66 +921,79 @@ async def myteam_setup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # =================== Message handlers ===================
+class _NotMainChat(filters.MessageFilter):
+    """MAIN guruh xabarlarini PTB filtrida to‘xtatadi — driver_message_handler umuman chaqirilmaydi.
+
+    Har safar joriy MAIN_GROUP_ID global'ini o‘qiydi, shuning uchun /setmaingroup faqat global'ni
+    o‘zgartiradi: umumiy filtr obyektini o‘zgartirish yoki handler'ni qayta qo‘shish shart emas.
+    MAIN esa /setmaingroup, bot qo‘shilganda (my_chat_member) va ishga tushganda ro‘yxatga olinadi.
+    """
+
+    def filter(self, message: Message) -> bool:
+        return message.chat.id != MAIN_GROUP_ID
+
+
+_DRIVER_FILTER = filters.ChatType.GROUPS & ~filters.StatusUpdate.ALL & _NotMainChat()
+
+
 async def driver_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Guruh turi va MAIN tekshiruvi _DRIVER_FILTER'da (handler ro‘yxatga olinganda) qilingan
     chat = update.effective_chat
     msg = update.effective_message
-    if not chat or chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+    if not chat or not msg:
         return
 
     # Register group title/id for /runninggroups
-    await _ensure_group_registered(chat)
-
-    # If MAIN group — skip watchdog and analytics
-    if MAIN_GROUP_ID is not None and chat.id == MAIN_GROUP_ID:
-        return
+    _ensure_group_registered(chat)
 
+    chat_id = chat.id
     # If group is paused — do nothing (no analytics, no watchdog)
-    if chat.id in INACTIVE_GROUPS:
+    if chat_id in INACTIVE_GROUPS:
         return
 
-    if not msg:
-        return
+    text = _text(msg)
 
     # 1) PIN-only duplicate check (bot xabarlari ham)
-    try:
-        await process_pin_duplicate_forward(context, msg)
-    except Exception as e:
-        log.warning("pin duplicate check failed: %s", e)
-
-    # 2) Analytics: driver xabari / team javobi matching
-    now = time.time()
-    if msg.from_user and not msg.from_user.is_bot:
-        if is_team_user(update):
-            # team reply
-            last_ts = LAST_DRIVER_TS.get(chat.id)
-            if last_ts:
+    # MAIN yo‘q yoki '#' yo‘q bo‘lsa (rasm/stiker/oddiy matn) — korutina ham yaratilmaydi, purge ham yo‘q
+    if MAIN_GROUP_ID is not None and "#" in text:
+        try:
+            await process_pin_duplicate_forward(context, msg, text)
+        except Exception as e:
+            log.warning("pin duplicate check failed: %s", e)
+
+    user = msg.from_user
+    if user is not None and user.is_bot:
+        # 2) Agar xabarni bot yuborgan bo‘lsa, shu yerda to‘xtaymiz (analytics/watchdog yo‘q)
+        return
+    team = is_team_user(update)
+
+    # 3) Analytics: driver xabari / team javobi matching
+    # (faqat oraliq kerak — monotonic loop.time(); epoch ts'ni _record_reply o‘zi oladi)
+    if user is not None:
+        now = asyncio.get_running_loop().time()
+        if team:
+            # team reply (pop: bir driverga faqat birinchi team javobi sanalsin)
+            last_ts = LAST_DRIVER_TS.pop(chat_id, None)
+            if last_ts is not None:
                 diff = now - last_ts
                 if 0 <= diff <= MAX_REPLY_WINDOW_SEC:
-                    user = msg.from_user
                     _record_reply(
                         user_id=user.id,
                         username=(user.username or "").lower(),
                         name=user.full_name or "",
                         seconds=diff,
-                        ts=now,
                     )
-                # Bir driverga faqat birinchi team javobi sanalsin:
-                LAST_DRIVER_TS.pop(chat.id, None)
         else:
             # driver message — yangi boshlanish
-            LAST_DRIVER_TS[chat.id] = now
-
-    # 3) Agar xabarni bot yuborgan bo‘lsa, shu yerda to‘xtaymiz (watchdog yo‘q)
-    if msg.from_user and msg.from_user.is_bot:
-        return
+            LAST_DRIVER_TS[chat_id] = now
 
     # 4) TEAM a’zosi yozsa → 90s taymerni bekor qilamiz
-    if is_team_user(update):
-        await cancel_pending(chat.id)
+    if team:
+        cancel_pending(chat_id)
         return
 
     # 5) Oddiy foydalanuvchi xabari → 90s watchdog
-    await schedule_alert(context, chat.id, msg)
+    schedule_alert(chat_id, msg)
 
 
 async def my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -669,20 +1001,63 @@ async def my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not chat:
         return
     # auto-register when added to a group
-    await _ensure_group_registered(chat)
+    _ensure_group_registered(chat)
 
     status = update.my_chat_member.new_chat_member.status
     if status in (ChatMember.KICKED, ChatMember.LEFT):
-        await cancel_pending(chat.id)
+        cancel_pending(chat.id)
 
 
 # ============ Entrypoint ============
 
+_BACKGROUND_TASKS: List[asyncio.Task] = []
+
+
+async def _register_main_group(bot) -> None:
+    # MAIN xabarlari driver handler'ga kelmaydi — nomini bir marta Bot API'dan olib ro‘yxatga qo‘shamiz
+    if MAIN_GROUP_ID is None or MAIN_GROUP_ID in KNOWN_GROUPS:
+        return
+    try:
+        _ensure_group_registered(await bot.get_chat(MAIN_GROUP_ID))
+    except Exception as e:
+        log.warning("Could not register MAIN group %s: %s", MAIN_GROUP_ID, e)
+
+
+async def _post_init(app) -> None:
+    await _register_main_group(app.bot)
+    _BACKGROUND_TASKS.append(asyncio.create_task(_alert_scheduler(app.bot)))
+    _BACKGROUND_TASKS.append(asyncio.create_task(_persist_loop()))
+    _BACKGROUND_TASKS.append(asyncio.create_task(_stats_writer_loop()))
+
+
+async def _post_shutdown(app) -> None:
+    for task in _BACKGROUND_TASKS:
+        task.cancel()
+    _BACKGROUND_TASKS.clear()
+    # _flush_dirty avval yarim qolgan yozish thread'ini kutadi, keyin oxirgi o‘zgarishlarni yozadi
+    await _flush_dirty()
+    pending_stats = _drain_stats_queue()
+    if pending_stats:
+        _append_stats(pending_stats)
+
+
 def main():
+    if uvloop is not None:
+        # run_polling loop'ni shu policy orqali yaratadi
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     _load_stats()
     _load_groups()
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # PTB allaqachon bitta httpx klientini qayta ishlatadi; HTTP/2 esa alert/warning
+        # so‘rovlarini bitta TLS ulanishida multiplex qiladi
+        .http_version("2")
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("status", status_cmd))
@@ -701,17 +1076,28 @@ def main():
 
     # Analysis
     app.add_handler(CommandHandler("analiz", analiz_cmd))
-    app.add_handler(CallbackQueryHandler(analiz_cb, pattern=r"^(ANALYZE|ANALYZE_MY):"))
+    app.add_handler(CallbackQueryHandler(analiz_cb_all, pattern=r"^ANALYZE:"))
+    app.add_handler(CallbackQueryHandler(analiz_cb_my, pattern=r"^ANALYZE_MY:"))
     app.add_handler(CommandHandler("myteamanalizsetup", myteam_setup_cmd))
 
     app.add_handler(ChatMemberHandler(my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
-    app.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.StatusUpdate.ALL, driver_message_handler))
+    app.add_handler(MessageHandler(_DRIVER_FILTER, driver_message_handler))
 
     log.info(
         "Watchdog 90s started. MAIN=%s Delay=%ss DUP_TTL=%ss WARN_ON_DUP=%s",
         MAIN_GROUP_ID, ALERT_DELAY_SECONDS, DUP_TTL_SECONDS, WARN_ON_DUP
     )
-    app.run_polling(drop_pending_updates=True)
+    # Uzunroq long-poll + faqat kerakli update turlari (kamroq so‘rov, kichikroq JSON)
+    app.run_polling(
+        drop_pending_updates=True,
+        timeout=30,
+        allowed_updates=[
+            Update.MESSAGE,
+            Update.EDITED_MESSAGE,
+            Update.CALLBACK_QUERY,
+            Update.MY_CHAT_MEMBER,
+        ],
+    )
 
 
 if __name__ == "__main__":
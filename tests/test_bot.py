@@ -0,0 +1,284 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import types
+import unittest
+from datetime import datetime
+
+_TMP = tempfile.mkdtemp()
+os.environ.update({
+    "BOT_TOKEN": "123:test",
+    "MAIN_GROUP_ID": "-100",
+    "OWNER_IDS": "1",
+    "TEAM_USERNAMES": "boss",
+    "STATS_FILE": os.path.join(_TMP, "reply_stats.json"),
+    "GROUPS_FILE": os.path.join(_TMP, "groups.json"),
+    "INACTIVE_FILE": os.path.join(_TMP, "inactive_groups.json"),
+    "ANALYZE_TEAM_FILE": os.path.join(_TMP, "analyze_team.json"),
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from telegram import Chat, Message, Update, User  # noqa: E402
+from telegram.ext import MessageHandler  # noqa: E402
+
+MAIN_ID = -100
+DRIVER_ID = -200
+
+
+def _group_update(chat_id: int, text: str = "hi", user_id: int = 7, username: str = "drv") -> Update:
+    chat = Chat(chat_id, Chat.SUPERGROUP, title=f"G{chat_id}")
+    user = User(user_id, username, False, username=username)
+    return Update(1, message=Message(1, datetime.now(), chat, from_user=user, text=text))
+
+
+class StatsWriterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        if os.path.exists(bot.STATS_FILE):
+            os.remove(bot.STATS_FILE)
+        bot._load_stats()
+        bot._drain_stats_queue()
+        self._flush_sec = bot.STATS_FLUSH_SEC
+        bot.STATS_FLUSH_SEC = 0.2
+
+    def tearDown(self):
+        bot.STATS_FLUSH_SEC = self._flush_sec
+
+    async def _run_writer_then_cancel(self, wait) -> None:
+        writer = asyncio.create_task(bot._stats_writer_loop())
+        try:
+            bot._record_reply(user_id=7, username="boss", name="Boss", seconds=12.0)
+            await wait()
+        finally:
+            writer.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await writer
+        # _post_shutdown'dagi kabi: navbatda qolgan narsa yo‘q bo‘lishi kerak
+        self.assertEqual(bot._drain_stats_queue(), [])
+
+    async def _file_has_line(self) -> None:
+        # Qat'iy sleep o‘rniga: writer thread'i qatorni to‘liq yozib bo‘lguncha kutamiz
+        async def poll():
+            while True:
+                if os.path.exists(bot.STATS_FILE):
+                    with open(bot.STATS_FILE, "rb") as f:
+                        if f.read().endswith(b"\n"):
+                            return
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(poll(), 5)
+
+    def _reloaded_count(self) -> float:
+        bot._load_stats()
+        with open(bot.STATS_FILE, "rb") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        return next(iter(bot.AGG[bot._json_loads(lines[0])["ym"]].values()))["count"]
+
+    async def test_record_is_appended_once_after_flush(self):
+        await self._run_writer_then_cancel(self._file_has_line)
+        self.assertEqual(self._reloaded_count(), 1.0)
+
+    async def test_shutdown_while_writer_sleeps_keeps_record_once(self):
+        await self._run_writer_then_cancel(lambda: asyncio.sleep(0.05))  # writer navbatdan oldi va sleep ichida
+        self.assertEqual(self._reloaded_count(), 1.0)
+
+    def test_legacy_json_array_is_migrated_to_jsonl(self):
+        rec = {"ts": 1.0, "ym": "2025-10", "user_id": 7, "username": "boss", "name": "Boss", "seconds": 5.0}
+        with open(bot.STATS_FILE, "w") as f:
+            f.write("[" + bot._json_dumps(rec).decode() + "]")
+        self.assertEqual(self._reloaded_count(), 1.0)
+
+
+class MainGroupFilterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        bot.MAIN_GROUP_ID = MAIN_ID
+        bot.PENDING.clear()
+        bot.LAST_DRIVER_TS.clear()
+        bot.KNOWN_GROUPS.clear()
+        bot.AGG.clear()
+        bot._drain_stats_queue()
+        self.handler = MessageHandler(bot._DRIVER_FILTER, bot.driver_message_handler)
+
+    async def _dispatch(self, update: Update) -> None:
+        # main()'dagi ro‘yxatga olish bilan bir xil: avval filtr, keyin callback
+        if self.handler.check_update(update):
+            await bot.driver_message_handler(update, types.SimpleNamespace(bot=None))
+
+    async def test_main_group_message_is_neither_scheduled_nor_counted(self):
+        # driver xabari (MAIN) va team javobi (MAIN) — hech biri watchdog/analytics'ga tushmasligi kerak
+        await self._dispatch(_group_update(MAIN_ID))
+        await self._dispatch(_group_update(MAIN_ID, user_id=9, username="boss"))
+        self.assertNotIn(MAIN_ID, bot.PENDING)
+        self.assertNotIn(MAIN_ID, bot.LAST_DRIVER_TS)
+        self.assertEqual(bot.AGG, {})
+        self.assertTrue(bot.STATS_QUEUE.empty())
+
+    async def test_driver_group_message_is_scheduled(self):
+        await self._dispatch(_group_update(DRIVER_ID))
+        self.assertIn(DRIVER_ID, bot.PENDING)
+        self.assertIn(DRIVER_ID, bot.LAST_DRIVER_TS)
+
+    async def test_setmaingroup_moves_filter_and_registers_main(self):
+        async def reply_text(*args, **kwargs):
+            pass
+        owner = types.SimpleNamespace(
+            effective_chat=Chat(DRIVER_ID, Chat.SUPERGROUP, title="New main"),
+            effective_user=types.SimpleNamespace(id=1),
+            message=types.SimpleNamespace(reply_text=reply_text),
+        )
+        await bot.set_main_cmd(owner, None)
+        self.assertEqual(bot.KNOWN_GROUPS.get(DRIVER_ID), "New main")
+
+        await self._dispatch(_group_update(DRIVER_ID))
+        await self._dispatch(_group_update(MAIN_ID))
+        self.assertNotIn(DRIVER_ID, bot.PENDING)
+        self.assertIn(MAIN_ID, bot.PENDING)
+
+    async def test_main_group_is_registered_at_startup(self):
+        class FakeBot:
+            async def get_chat(self, chat_id):
+                return Chat(chat_id, Chat.SUPERGROUP, title="Main")
+        await bot._register_main_group(FakeBot())
+        self.assertEqual(bot.KNOWN_GROUPS.get(MAIN_ID), "Main")
+
+
+class AlertSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._delay = bot.ALERT_DELAY_SECONDS
+        bot.ALERT_DELAY_SECONDS = 0.2
+        bot.MAIN_GROUP_ID = MAIN_ID
+        bot.INACTIVE_GROUPS.clear()
+        bot.PENDING.clear()
+        bot.ALERT_HEAP.clear()
+        # Event oldingi test loop'iga bog‘lanib qolmasin
+        bot._ALERT_WAKEUP = asyncio.Event()
+        self.sent = []
+        loop = asyncio.get_running_loop()
+        test = self
+
+        class FakeBot:
+            async def send_message(self, chat_id, text, **kwargs):
+                test.sent.append((chat_id, loop.time()))
+        self.scheduler = asyncio.create_task(bot._alert_scheduler(FakeBot()))
+        self.msg = _group_update(DRIVER_ID).message
+
+    async def asyncTearDown(self):
+        self.scheduler.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await self.scheduler
+        bot.ALERT_DELAY_SECONDS = self._delay
+
+    def _assert_idle(self):
+        self.assertEqual(bot.ALERT_HEAP, [])
+        self.assertEqual(bot.PENDING, {})
+
+    async def test_reschedule_fires_once_at_extended_deadline(self):
+        bot.schedule_alert(DRIVER_ID, self.msg)
+        await asyncio.sleep(0.1)
+        bot.schedule_alert(DRIVER_ID, self.msg)
+        deadline = bot.PENDING[DRIVER_ID]["deadline"]
+        await asyncio.sleep(0.4)
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0][0], MAIN_ID)
+        self.assertGreaterEqual(self.sent[0][1], deadline)
+        self._assert_idle()
+
+    async def test_cancel_pending_suppresses_alert(self):
+        bot.schedule_alert(DRIVER_ID, self.msg)
+        await asyncio.sleep(0.05)
+        bot.cancel_pending(DRIVER_ID)
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.sent, [])
+        self._assert_idle()
+
+    async def test_cancel_then_reschedule_fires_exactly_once(self):
+        bot.schedule_alert(DRIVER_ID, self.msg)
+        await asyncio.sleep(0.05)
+        bot.cancel_pending(DRIVER_ID)
+        bot.schedule_alert(DRIVER_ID, self.msg)
+        await asyncio.sleep(0.45)
+        self.assertEqual(len(self.sent), 1)
+        self._assert_idle()
+
+
+class DuplicateSeenTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        bot.DUP_SEEN.clear()
+        bot.DUP_ALERTED.clear()
+        self._max = bot.DUP_SEEN_MAX
+
+    def tearDown(self):
+        bot.DUP_SEEN_MAX = self._max
+
+    def test_negative_supergroup_id_round_trips(self):
+        for gid in (-1001234567890, -100, 0, 5):
+            self.assertEqual(bot._unpack_seen(bot._pack_seen(123456.7, gid)), (123456, gid))
+
+    def test_ttl_purge_stops_at_first_live_entry(self):
+        now = 5000.0 + bot.DUP_TTL_SECONDS
+        bot.DUP_SEEN["OLDHEAD1"] = bot._pack_seen(1000, DRIVER_ID)
+        bot.DUP_SEEN["LIVEMID1"] = bot._pack_seen(5500, DRIVER_ID)
+        # muddati o‘tgan, lekin tirik yozuv ortida — head-only purge unga yetib bormaydi
+        bot.DUP_SEEN["OLDTAIL1"] = bot._pack_seen(1000, DRIVER_ID)
+        bot._purge_expired_duplicates(now)
+        self.assertEqual(list(bot.DUP_SEEN), ["LIVEMID1", "OLDTAIL1"])
+
+    async def test_cap_eviction_drops_alerted_entry(self):
+        class FakeBot:
+            async def send_message(self, *args, **kwargs):
+                pass
+        context = types.SimpleNamespace(bot=FakeBot())
+        bot.DUP_SEEN_MAX = 2
+
+        async def pin(chat_id, load_id):
+            msg = _group_update(chat_id, text=f"1# : {load_id}").message
+            await bot.process_pin_duplicate_forward(context, msg, msg.text)
+
+        await pin(DRIVER_ID, "LOADAAA1")
+        await pin(-300, "LOADAAA1")
+        self.assertEqual(bot.DUP_ALERTED.get("LOADAAA1"), {-300})
+        await pin(DRIVER_ID, "LOADBBB2")
+        await pin(DRIVER_ID, "LOADCCC3")
+        self.assertEqual(list(bot.DUP_SEEN), ["LOADBBB2", "LOADCCC3"])
+        self.assertNotIn("LOADAAA1", bot.DUP_ALERTED)
+
+
+class PersistShutdownTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._write_all = bot._write_all
+        self.spans = []
+
+        def slow_write_all(writes):
+            start = time.monotonic()
+            time.sleep(0.2)
+            self.spans.append((start, time.monotonic()))
+        bot._write_all = slow_write_all
+
+    def tearDown(self):
+        bot._write_all = self._write_all
+        bot._DIRTY.clear()
+
+    async def test_final_flush_waits_for_cancelled_inflight_write(self):
+        bot._mark_dirty("groups")
+        persist = asyncio.create_task(bot._flush_dirty())
+        await asyncio.sleep(0.05)  # thread yozish ichida
+        persist.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await persist
+        bot._mark_dirty("team")
+        await bot._flush_dirty()
+        self.assertEqual(len(self.spans), 2)
+        self.assertLessEqual(self.spans[0][1], self.spans[1][0])
+
+    def test_atomic_write_leaves_no_tmp_files(self):
+        path = os.path.join(_TMP, "atomic.json")
+        bot._atomic_write(path, b"{}")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"{}")
+        self.assertFalse([n for n in os.listdir(_TMP) if n.endswith(".tmp")])
+
+
+if __name__ == "__main__":
+    unittest.main()